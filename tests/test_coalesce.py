@@ -0,0 +1,70 @@
+import asyncio
+import tempfile
+import unittest
+
+from wuthering_spider import HakushinSpider
+
+
+class CoalesceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spider = HakushinSpider(self.tmp.name, ["en"])
+
+    async def asyncTearDown(self):
+        await self.spider.client.aclose()
+        self.tmp.cleanup()
+
+    async def test_waiters_share_result(self):
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 42
+
+        results = await asyncio.gather(
+            self.spider._coalesce("k", work), self.spider._coalesce("k", work)
+        )
+        self.assertEqual(results, [42, 42])
+        self.assertEqual(calls, 1)
+        self.assertEqual(self.spider._inflight, {})
+
+    async def test_cancelled_waiter_does_not_affect_owner(self):
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return 42
+
+        owner = asyncio.create_task(self.spider._coalesce("k", work))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(self.spider._coalesce("k", work))
+        other = asyncio.create_task(self.spider._coalesce("k", work))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual(await owner, 42)
+        self.assertEqual(await other, 42)
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(self.spider._inflight, {})
+
+    async def test_owner_exception_reaches_waiters(self):
+        async def work():
+            await asyncio.sleep(0.01)
+            raise OSError("disk full")
+
+        results = await asyncio.gather(
+            self.spider._coalesce("k", work),
+            self.spider._coalesce("k", work),
+            return_exceptions=True,
+        )
+        self.assertEqual([type(r) for r in results], [OSError, OSError])
+
+
+if __name__ == "__main__":
+    unittest.main()
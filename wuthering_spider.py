@@ -1,22 +1,61 @@
 import asyncio
 import argparse
+import contextlib
+import functools
 import json
 import logging
+import random
 import sys
 import re
+import string
+from collections import deque
 from pathlib import Path
-from typing import List, Dict, Set, Any, Optional
+from typing import Awaitable, Callable, List, Dict, Set, Any, Optional
 from urllib.parse import urljoin
 
 import httpx
 from tqdm.asyncio import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 BASE_API_URL = "https://api.hakush.in/ww/data/"
 BASE_ASSET_URL = "https://api.hakush.in/ww/"
 
 DEFAULT_LANGS = ["zh", "en", "ja", "ko"]
 TIMEOUT = 30
-MAX_CONCURRENCY = 15
+RETRIES = 3
+# Backoff doubles from RETRY_BASE_DELAY per attempt, capped at MAX_RETRY_DELAY
+RETRY_BASE_DELAY = 0.25
+MAX_RETRY_DELAY = 8.0
+# Upper bound on how long a server-sent Retry-After may stall one request
+MAX_RETRY_AFTER = 60.0
+# Completed downloads (URL -> size), kept in the output directory between runs
+MANIFEST_FILE = "manifest.json"
+# Item workers per category; JSON requests are bounded by the connection pool,
+# and HTTP/2 multiplexes them as streams over one connection per host
+MAX_CONCURRENCY = 100
+MAX_CONNECTIONS = 100
+# Caps image requests in flight until their headers arrive; the bodies are
+# streamed after the semaphore is released and are bounded only by the pool
+MAX_DOWNLOAD_CONCURRENCY = 30
+# Bodies below this size are read in one go; larger ones stream in chunks
+SMALL_ASSET_BYTES = 1 << 20
+STREAM_CHUNK_SIZE = 1 << 20
+# Seconds between progress bar repaints
+PROGRESS_INTERVAL = 0.1
+# Strings shorter than this are never worth testing as asset paths
+MIN_ASSET_PATH_LEN = 10
+# Unique asset paths are a few thousand; the bound only guards against runaway input
+PATH_CACHE_SIZE = 200_000
+
+GAME_PATH_PREFIX = "/Game/Aki/"
+# Trailing Unreal object name, e.g. ".T_IconA_hsb_UI" in "T_IconA_hsb_UI.T_IconA_hsb_UI"
+_EXT_RE = re.compile(r"\.[^/]+$")
+# Path characters that urljoin leaves untouched
+_PLAIN_PATH_CHARS = frozenset(string.ascii_letters + string.digits + "_-/")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,6 +65,7 @@ logging.basicConfig(
 logger = logging.getLogger("WWSpider")
 
 
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
 def parse_game_asset_path(game_path: str) -> Optional[str]:
     """
     Converts Unreal Engine internal paths to Web URLs.
@@ -35,12 +75,27 @@ def parse_game_asset_path(game_path: str) -> Optional[str]:
     if not isinstance(game_path, str) or not game_path:
         return None
 
-    clean_path = game_path.replace("/Game/Aki/", "/")
+    if game_path.startswith(GAME_PATH_PREFIX):
+        # Fast path for the usual ".../Name.Name" shape: same result as below
+        # without the regex or urljoin
+        tail = game_path[len(GAME_PATH_PREFIX) :]
+        head, _, name = tail.rpartition(".")
+        if (
+            name
+            and head.rpartition("/")[2] == name
+            and not head.startswith("/")
+            and "//" not in head
+            and GAME_PATH_PREFIX not in tail
+            and _PLAIN_PATH_CHARS.issuperset(head)
+        ):
+            return BASE_ASSET_URL + head + ".webp"
+
+    clean_path = game_path.replace(GAME_PATH_PREFIX, "/")
 
     if "/" not in clean_path:
         return None
 
-    clean_path = re.sub(r"\.[^/]+$", "", clean_path)
+    clean_path = _EXT_RE.sub("", clean_path)
 
     if not clean_path.lower().endswith((".png", ".jpg", ".webp")):
         clean_path += ".webp"
@@ -48,6 +103,39 @@ def parse_game_asset_path(game_path: str) -> Optional[str]:
     return urljoin(BASE_ASSET_URL, clean_path.lstrip("/"))
 
 
+def _loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _dumps(data: Any) -> bytes:
+    """Serializes data as UTF-8 JSON with 2-space indent (same bytes either way)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _write_json(path: Path, data: Any) -> int:
+    raw = _dumps(data)
+    path.write_bytes(raw)
+    return len(raw)
+
+
+def _is_retriable(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+def _retry_delay(attempt: int, resp: Optional[httpx.Response] = None) -> float:
+    """Honors Retry-After (seconds form) on 429/503, else backs off with jitter"""
+    if resp is not None and resp.status_code in (429, 503):
+        retry_after = resp.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_AFTER)
+    delay = min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * (2**attempt))
+    return delay + random.uniform(0, RETRY_BASE_DELAY)
+
+
 class HakushinSpider:
     def __init__(self, output_dir: str, langs: List[str], force: bool = False):
         self.output_dir = Path(output_dir)
@@ -56,100 +144,246 @@ class HakushinSpider:
         self.client = httpx.AsyncClient(
             timeout=TIMEOUT,
             follow_redirects=True,
-            limits=httpx.Limits(max_keepalive_connections=20, max_connections=30),
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=MAX_CONNECTIONS,
+                max_connections=MAX_CONNECTIONS,
+            ),
             headers={
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
                 "Referer": "https://hakush.in/",
             },
         )
-        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.download_semaphore = asyncio.Semaphore(MAX_DOWNLOAD_CONCURRENCY)
         self.global_image_urls: Set[str] = set()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._manifest: Dict[str, int] = self._load_manifest()
+        self._created_dirs: Set[Path] = set()
+        self._completed = 0
 
     async def close(self):
         await self.client.aclose()
+        self._save_manifest()
+
+    def _load_manifest(self) -> Dict[str, int]:
+        try:
+            return _loads((self.output_dir / MANIFEST_FILE).read_bytes())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self) -> None:
+        self._ensure_dir(self.output_dir)
+        _write_json(
+            self.output_dir / MANIFEST_FILE, dict(sorted(self._manifest.items()))
+        )
+
+    def _ensure_dir(self, path: Path) -> None:
+        if path not in self._created_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path)
+
+    @contextlib.asynccontextmanager
+    async def track_progress(self, pbar: tqdm):
+        """Batch completion counts into pbar instead of updating per task"""
+
+        async def ticker():
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                flush()
+
+        def flush():
+            nonlocal shown
+            if self._completed != shown:
+                pbar.update(self._completed - shown)
+                shown = self._completed
+
+        shown = self._completed
+        task = asyncio.create_task(ticker())
+        try:
+            yield
+        finally:
+            task.cancel()
+            flush()
+
+    async def _coalesce(self, key: str, work: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run work() once per key; concurrent callers await the same result.
+        Defensive only: the crawl itself never has two requests in flight for
+        one URL or asset path, so nothing is expected to coalesce today.
+        """
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # Shielded so a cancelled waiter does not cancel the owner's future
+            return await asyncio.shield(fut)
+
+        # No await between the lookup and the insert, so no lock is needed
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await work()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            if not fut.done():
+                fut.set_exception(e)
+                # Mark it retrieved so asyncio does not warn when nobody else waited
+                fut.exception()
+            raise
+        else:
+            if not fut.done():
+                fut.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
 
     async def fetch_json(self, url: str, ignore_404: bool = False) -> Optional[Any]:
-        for attempt in range(3):
+        return await self._coalesce(url, lambda: self._fetch_json(url, ignore_404))
+
+    async def _fetch_json(self, url: str, ignore_404: bool) -> Optional[Any]:
+        raw = await self.fetch_bytes(url, ignore_404=ignore_404)
+        if raw is None:
+            return None
+        try:
+            return _loads(raw)
+        except ValueError as e:
+            logger.error(f"Invalid JSON from {url}: {e}")
+            return None
+
+    async def fetch_bytes(self, url: str, ignore_404: bool = False) -> Optional[bytes]:
+        for attempt in range(RETRIES):
+            resp = None
             try:
-                async with self.semaphore:
-                    resp = await self.client.get(url)
-                    if resp.status_code == 404:
-                        if not ignore_404:
-                            logger.warning(f"404 Not Found: {url}")
-                        return None
-                    resp.raise_for_status()
-                    return resp.json()
+                resp = await self.client.get(url)
+                if resp.status_code == 404:
+                    if not ignore_404:
+                        logger.warning(f"404 Not Found: {url}")
+                    return None
+                if resp.is_error and not _is_retriable(resp.status_code):
+                    logger.error(f"Failed to fetch {url}: HTTP {resp.status_code}")
+                    return None
+                resp.raise_for_status()
+                return resp.content
             except Exception as e:
-                if attempt == 2:
-                    logger.error(f"Failed to fetch JSON {url}: {e}")
+                if attempt == RETRIES - 1:
+                    logger.error(f"Failed to fetch {url}: {e}")
                     return None
-                await asyncio.sleep(0.5)
+                await asyncio.sleep(_retry_delay(attempt, resp))
         return None
 
     async def download_file(self, url: str, save_path: Path) -> bool:
-        if save_path.exists() and not self.force:
-            if save_path.stat().st_size > 0:
+        # Keyed by destination: distinct URLs can share a filename in assets/
+        return await self._coalesce(
+            str(save_path), lambda: self._download_file(url, save_path)
+        )
+
+    async def _download_file(self, url: str, save_path: Path) -> bool:
+        if not self.force:
+            if self._manifest.get(url, 0) > 0:
+                return True
+            # Files from before the manifest existed are picked up once by stat
+            if save_path.exists() and (size := save_path.stat().st_size) > 0:
+                self._manifest[url] = size
                 return True
 
-        save_path.parent.mkdir(parents=True, exist_ok=True)
+        self._ensure_dir(save_path.parent)
 
-        for attempt in range(3):
+        for attempt in range(RETRIES):
+            resp = None
             try:
-                async with self.semaphore:
-                    async with self.client.stream("GET", url) as resp:
-                        if resp.status_code != 200:
-                            return False
-                        temp_path = save_path.with_suffix(".tmp")
-                        with open(temp_path, "wb") as f:
-                            async for chunk in resp.aiter_bytes():
-                                f.write(chunk)
-                        if temp_path.exists():
-                            temp_path.replace(save_path)
-                        return True
+                request = self.client.build_request("GET", url)
+                async with self.download_semaphore:
+                    resp = await self.client.send(request, stream=True)
+                try:
+                    if resp.status_code != 200:
+                        if _is_retriable(resp.status_code):
+                            resp.raise_for_status()
+                        return False
+                    temp_path = save_path.with_name(save_path.name + ".tmp")
+                    length = resp.headers.get("Content-Length", "")
+                    if length.isdigit() and int(length) < SMALL_ASSET_BYTES:
+                        body = await resp.aread()
+                        await asyncio.to_thread(temp_path.write_bytes, body)
+                        size = len(body)
+                    else:
+                        size = 0
+                        f = await asyncio.to_thread(open, temp_path, "wb")
+                        try:
+                            async for chunk in resp.aiter_bytes(STREAM_CHUNK_SIZE):
+                                await asyncio.to_thread(f.write, chunk)
+                                size += len(chunk)
+                        finally:
+                            await asyncio.to_thread(f.close)
+                    temp_path.replace(save_path)
+                    self._manifest[url] = size
+                    return True
+                finally:
+                    await resp.aclose()
             except Exception as e:
-                if attempt == 2:
+                if attempt == RETRIES - 1:
                     logger.error(f"Failed download asset {url}: {e}")
                     return False
-                await asyncio.sleep(1)
+                await asyncio.sleep(_retry_delay(attempt, resp))
         return False
 
-    def extract_images_from_data(self, data: Any) -> None:
-        """Recursively find image paths in JSON"""
-        if isinstance(data, dict):
-            for v in data.values():
-                self.extract_images_from_data(v)
-        elif isinstance(data, list):
-            for item in data:
-                self.extract_images_from_data(item)
-        elif isinstance(data, str):
-            if "/Game/Aki/" in data or ("/UI/" in data and "." in data):
-                real_url = parse_game_asset_path(data)
-                if real_url:
-                    self.global_image_urls.add(real_url)
+    def extract_images_from_data(self, data: Any, out: Set[str]) -> None:
+        """Walk the JSON tree iteratively and collect image URLs into out"""
+        _add = out.add
+        stack = deque([data])
+        while stack:
+            node = stack.pop()
+            t = type(node)
+            if t is dict:
+                stack.extend(node.values())
+            elif t is list:
+                stack.extend(node)
+            elif t is str:
+                if len(node) < MIN_ASSET_PATH_LEN:
+                    continue
+                if node.startswith(GAME_PATH_PREFIX) or (
+                    node.startswith("/UI/") and "." in node
+                ):
+                    real_url = parse_game_asset_path(node)
+                    if real_url:
+                        _add(real_url)
 
     async def process_category(
         self, category_name: str, index_file: str, detail_prefix: str, pbar_main: tqdm
     ):
         """Process a specific category (e.g., character, weapon)"""
 
-        index_url = urljoin(BASE_API_URL, f"en/{index_file}")
-        index_data = await self.fetch_json(index_url)
-
-        if not index_data:
-            index_url = urljoin(BASE_API_URL, index_file)
-            index_data = await self.fetch_json(index_url)
+        index_path = self.output_dir / category_name / "index.json"
+        index_data = None
+        if not self.force:
+            try:
+                index_data = _loads(await asyncio.to_thread(index_path.read_bytes))
+            except (OSError, ValueError):
+                pass
 
         if not index_data:
-            logger.error(f"Index not found: {category_name}")
-            return
-
-        self.extract_images_from_data(index_data)
-
-        (self.output_dir / category_name).mkdir(parents=True, exist_ok=True)
-        with open(
-            self.output_dir / category_name / "index.json", "w", encoding="utf-8"
-        ) as f:
-            json.dump(index_data, f, ensure_ascii=False, indent=2)
+            index_urls = [
+                urljoin(BASE_API_URL, f"en/{index_file}"),
+                urljoin(BASE_API_URL, index_file),
+            ]
+            # Start with the URL that resolved last time to skip a failed probe
+            index_urls.sort(key=lambda u: u not in self._manifest)
+            for index_url in index_urls:
+                index_data = await self.fetch_json(index_url)
+                if index_data:
+                    break
+
+            if not index_data:
+                logger.error(f"Index not found: {category_name}")
+                return
+
+            self._ensure_dir(index_path.parent)
+            self._manifest[index_url] = await asyncio.to_thread(
+                _write_json, index_path, index_data
+            )
+
+        urls: Set[str] = set()
+        self.extract_images_from_data(index_data, urls)
+        self.global_image_urls |= urls
 
         if category_name == "item":
             return
@@ -162,33 +396,42 @@ class HakushinSpider:
 
         id_list = [i for i in id_list if i]
 
+        for lang in self.langs:
+            self._ensure_dir(self.output_dir / category_name / lang)
+
         pbar_main.total += len(id_list) * len(self.langs)
         pbar_main.refresh()
 
-        tasks = []
+        queue: asyncio.Queue = asyncio.Queue()
         for item_id in id_list:
             for lang in self.langs:
-                tasks.append(
-                    self.process_single_item(
-                        category_name, detail_prefix, item_id, lang, pbar_main
-                    )
+                queue.put_nowait((item_id, lang))
+
+        # A fixed pool of workers keeps memory proportional to concurrency
+        # rather than to the number of item/language pairs
+        async def worker():
+            while not queue.empty():
+                item_id, lang = queue.get_nowait()
+                await self.process_single_item(
+                    category_name, detail_prefix, item_id, lang
                 )
 
-        await asyncio.gather(*tasks)
+        await asyncio.gather(*(worker() for _ in range(MAX_CONCURRENCY)))
 
     async def process_single_item(
-        self, category: str, prefix: str, item_id: str, lang: str, pbar: tqdm
+        self, category: str, prefix: str, item_id: str, lang: str
     ):
         try:
             url = f"{BASE_API_URL}{lang}/{prefix}/{item_id}.json"
             save_path = self.output_dir / category / lang / f"{item_id}.json"
 
             data = None
-            if save_path.exists() and not self.force:
+            if not self.force and (url in self._manifest or save_path.exists()):
                 try:
-                    with open(save_path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                except:
+                    raw = await asyncio.to_thread(save_path.read_bytes)
+                    data = _loads(raw)
+                    self._manifest[url] = len(raw)
+                except (OSError, ValueError):
                     pass
 
             if not data:
@@ -196,40 +439,46 @@ class HakushinSpider:
                 data = await self.fetch_json(url, ignore_404=ignore_404)
 
                 if data:
-                    save_path.parent.mkdir(parents=True, exist_ok=True)
-                    with open(save_path, "w", encoding="utf-8") as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    self._manifest[url] = await asyncio.to_thread(
+                        _write_json, save_path, data
+                    )
 
             if data:
-                self.extract_images_from_data(data)
+                urls: Set[str] = set()
+                self.extract_images_from_data(data, urls)
+                self.global_image_urls |= urls
 
         finally:
-            pbar.update(1)
+            self._completed += 1
 
     async def download_all_images(self):
         if not self.global_image_urls:
             return
 
-        logger.info(f"Downloading {len(self.global_image_urls)} unique images...")
+        # assets/ is flat, so the filename is what identifies an image on disk;
+        # URLs that would land on the same file are only downloaded once
+        targets: Dict[str, str] = {}
+        for url in sorted(self.global_image_urls):
+            targets.setdefault(url.split("/")[-1], url)
+
+        logger.info(f"Downloading {len(targets)} unique images...")
         assets_dir = self.output_dir / "assets"
-        assets_dir.mkdir(exist_ok=True)
+        self._ensure_dir(assets_dir)
 
         tasks = []
-        pbar = tqdm(
-            total=len(self.global_image_urls), desc="Downloading Assets", unit="img"
-        )
+        pbar = tqdm(total=len(targets), desc="Downloading Assets", unit="img")
 
-        for url in self.global_image_urls:
-            filename = url.split("/")[-1]
+        for filename, url in targets.items():
             save_path = assets_dir / filename
-            tasks.append(self._download_wrapper(url, save_path, pbar))
+            tasks.append(self._download_wrapper(url, save_path))
 
-        await asyncio.gather(*tasks)
+        async with self.track_progress(pbar):
+            await asyncio.gather(*tasks)
         pbar.close()
 
-    async def _download_wrapper(self, url, path, pbar):
+    async def _download_wrapper(self, url, path):
         await self.download_file(url, path)
-        pbar.update(1)
+        self._completed += 1
 
 
 async def main():
@@ -260,9 +509,10 @@ async def main():
     try:
         pbar_json = tqdm(total=0, desc="Fetching JSON Data", unit="file")
 
-        for cat_name, idx_file, prefix in categories:
-            pbar_json.set_description(f"Processing {cat_name}")
-            await spider.process_category(cat_name, idx_file, prefix, pbar_json)
+        async with spider.track_progress(pbar_json):
+            for cat_name, idx_file, prefix in categories:
+                pbar_json.set_description(f"Processing {cat_name}")
+                await spider.process_category(cat_name, idx_file, prefix, pbar_json)
 
         pbar_json.close()
 
@@ -276,6 +526,19 @@ async def main():
 
 
 if __name__ == "__main__":
+    loop_factory = None
     if sys.platform == "win32":
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main())
+        try:
+            import winloop
+
+            loop_factory = winloop.new_event_loop
+        except ImportError:
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    else:
+        try:
+            import uvloop
+
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            pass
+    asyncio.run(main(), loop_factory=loop_factory)